@@ -3,10 +3,15 @@
 from cuda_lint import Linter
 import os
 import shutil
-import json
 import re
 from cudatext import *
 
+# Bundled executable: <CudaText>/tools/Ruff (constant per process)
+_BUNDLED_RUFF = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'tools', 'Ruff', 'ruff.exe' if os.name == 'nt' else 'ruff'
+)
+
 # Plugin loaded (lazy loading via CudaLint framework)
 print("Ruff: Plugin initialized")
 
@@ -21,7 +26,7 @@ class Ruff(Linter):
     DEFAULT_TIMEOUT = 30
 
     # Empty configuration dict (avoid typos in keys)
-    EMPTY_CONFIG = {'ignore': [], 'select': [], 'timeout': DEFAULT_TIMEOUT}
+    EMPTY_CONFIG = {'ignore': [], 'select': [], 'timeout': DEFAULT_TIMEOUT, 'debug': False, 'isolated': False}
 
     # Support all Python lexer variants
     syntax = 'Python'
@@ -36,15 +41,37 @@ class Ruff(Linter):
     # Example: test.py:4:8: F401 [*] `os` imported but unused
     # Example: test.py:3:7: invalid-syntax: Simple statements must be separated
     # Regex maps E*/F* codes as errors, others as warnings
-    regex = (
+    # Compiled here so matching never depends on framework recompiling it
+    regex = re.compile(
         r'^.+?:(?P<line>\d+):(?P<col>\d+): '
         r'(?:(?P<error>E\d+|F\d+)|(?P<warning>[\w-]+))'
         r'\s*:?\s+'
         r'(?P<message>.*)'
     )
 
-    # Compile regex once at class level
-    _RULE_CODE_PATTERN = re.compile(r'^[A-Z]{1,4}(?:\d+)?$|^ALL$')
+    # Summary lines in check output, e.g. "[*] 2 fixable with the `--fix` option."
+    _SUMMARY_LINE_RE = re.compile(r'^\[\*\] [^\r\n]*', re.M)
+
+    # Whole-line // and # comments in config file
+    _COMMENT_LINE_RE = re.compile(r'^\s*(?://|#).*$\n?', re.M)
+
+    # Executable lookup cache (shared by all instances, keyed on PATH)
+    _cached_executable = None
+    _executable_searched = False
+    _executable_env_path = None
+
+    # Parsed config cache: (path, mtime_ns, size, config)
+    _config_cache = None
+
+    # Built check commands: (ruff_path, select, ignore, isolated) -> cmd tuple
+    _cmd_cache = {}
+
+    # Ruff version cache: (ruff_path, version)
+    _version_cache = None
+
+    # Persistent `ruff server` worker (None until first format)
+    _worker = None
+    _worker_failed_path = None
 
     multiline = False
     tempfile_suffix = 'py'
@@ -52,23 +79,27 @@ class Ruff(Linter):
     def __init__(self, view):
         super().__init__(view)
 
+        # Load configuration first (debug flag gates diagnostic output)
+        config = self._load_config()
+        self.debug = config.get('debug', False)
+
         # Find Ruff executable
         self.ruff_path = self._find_executable()
         if not self.ruff_path:
             self.ignore_codes = []
             self.select_codes = []
             self.timeout = Ruff.DEFAULT_TIMEOUT
+            self.isolated = False
             return
 
-        # Load configuration
-        config = self._load_config()
         self.ignore_codes = config.get('ignore', [])
         self.select_codes = config.get('select', [])
         self.timeout = config.get('timeout', Ruff.DEFAULT_TIMEOUT)
+        self.isolated = config.get('isolated', False)
 
         # Use sensible defaults if no config exists
         if not self.ignore_codes and not self.select_codes:
-            print("Ruff: No config found, using default rules")
+            self._log("No config found, using default rules")
             self.select_codes = ['E', 'F', 'W', 'B', 'I']
             self.ignore_codes = []
 
@@ -80,26 +111,35 @@ class Ruff(Linter):
         self._log_status()
 
     def _find_executable(self):
+        """Locate Ruff once per PATH value, reusing the cached result."""
+        env_path = os.environ.get('PATH')
+
+        # Guard clause: already searched with the same PATH
+        if Ruff._executable_searched and Ruff._executable_env_path == env_path:
+            # Not found last time: bundled copy may have been installed since
+            if Ruff._cached_executable is None and os.path.isfile(_BUNDLED_RUFF):
+                self._log(f"Using bundled version: {_BUNDLED_RUFF}")
+                Ruff._cached_executable = _BUNDLED_RUFF
+            return Ruff._cached_executable
+
+        Ruff._cached_executable = self._search_executable()
+        Ruff._executable_env_path = env_path
+        Ruff._executable_searched = True
+        return Ruff._cached_executable
+
+    def _search_executable(self):
         """Locate Ruff: system PATH first, then bundled version."""
         # Try system PATH (cross-platform, including Windows)
         if path := shutil.which('ruff'):
-            print(f"Ruff: Found in PATH: {path}")
+            self._log(f"Found in PATH: {path}")
             return path
 
         # Try bundled version (Windows-specific handling)
-        try:
-            base = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
-            exe = 'ruff.exe' if os.name == 'nt' else 'ruff'
-            bundled = os.path.join(base, 'tools', 'Ruff', exe)
-
-            if os.path.isfile(bundled):
-                print(f"Ruff: Using bundled version: {bundled}")
-                return bundled
-
-            print(f"NOTE: Ruff not found in PATH or: {bundled}")
-        except (NameError, AttributeError) as e:
-            print(f"NOTE: Cannot locate bundled Ruff: {e}")
+        if os.path.isfile(_BUNDLED_RUFF):
+            self._log(f"Using bundled version: {_BUNDLED_RUFF}")
+            return _BUNDLED_RUFF
 
+        print(f"NOTE: Ruff not found in PATH or: {_BUNDLED_RUFF}")
         return None
 
     def _load_config(self):
@@ -107,31 +147,40 @@ class Ruff(Linter):
         path = os.path.join(app_path(APP_DIR_SETTINGS), self.CONFIG_FILE)
 
         # Guard clause: config file doesn't exist
-        if not os.path.isfile(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            Ruff._config_cache = None
             return Ruff.EMPTY_CONFIG.copy()
 
+        # Reuse parsed config while file is unchanged
+        cache = Ruff._config_cache
+        if cache and cache[:3] == (path, st.st_mtime_ns, st.st_size):
+            return cache[3].copy()
+
         # Read and parse config file
         content = self._read_config_file(path)
         if not content:
-            return Ruff.EMPTY_CONFIG.copy()
+            config = Ruff.EMPTY_CONFIG.copy()
+        else:
+            # Parse and validate
+            config = self._parse_and_validate_config(content)
 
-        # Parse and validate
-        return self._parse_and_validate_config(content)
+        Ruff._config_cache = (path, st.st_mtime_ns, st.st_size, config)
+        return config.copy()
 
     def _read_config_file(self, path):
         """Read config file with comment stripping and encoding fallback."""
         try:
             # Try UTF-8 first (standard)
             with open(path, 'r', encoding='utf-8') as f:
-                lines = [ln for ln in f if (stripped := ln.strip()) and not stripped.startswith(('//', '#'))]
-                return ''.join(lines).strip()
+                return self._COMMENT_LINE_RE.sub('', f.read()).strip() or None
 
         except UnicodeDecodeError:
             # Fallback to system default encoding (legacy Windows)
             try:
                 with open(path, 'r') as f:
-                    lines = [ln for ln in f if (stripped := ln.strip()) and not stripped.startswith(('//', '#'))]
-                    return ''.join(lines).strip()
+                    return self._COMMENT_LINE_RE.sub('', f.read()).strip() or None
             except Exception as e:
                 print(f"ERROR: Failed to read Ruff config with fallback encoding: {e}")
                 return None
@@ -148,14 +197,31 @@ class Ruff(Linter):
         - Category prefixes: E, W, F, B, I, C90, N, etc.
         - All rules: ALL
         """
-        return self._RULE_CODE_PATTERN.match(code) is not None
+        if code == 'ALL':
+            return True
+
+        # Prefix: 1-4 uppercase ASCII letters
+        n = 0
+        while n < 4 and n < len(code) and 'A' <= code[n] <= 'Z':
+            n += 1
+        if not n:
+            return False
+
+        # Suffix: optional ASCII digits
+        digits = code[n:]
+        return not digits or (digits.isascii() and digits.isdigit())
 
     def _filter_valid_codes(self, codes):
-        """Filter and validate rule codes."""
-        return [c for c in codes if isinstance(c, str) and self._validate_rule_code(c)]
+        """Split rule codes into (valid, invalid) lists in a single pass."""
+        valid, invalid = [], []
+        for c in codes:
+            (valid if isinstance(c, str) and self._validate_rule_code(c) else invalid).append(c)
+        return valid, invalid
 
     def _parse_and_validate_config(self, content):
         """Parse JSON and validate rule codes."""
+        import json
+
         try:
             config = json.loads(content)
 
@@ -182,27 +248,42 @@ class Ruff(Linter):
                 print(f"NOTE: Ruff - Invalid timeout '{timeout}', using default: {Ruff.DEFAULT_TIMEOUT}")
                 timeout = Ruff.DEFAULT_TIMEOUT
 
+            # Validate debug flag
+            debug = config.get('debug', False)
+            if not isinstance(debug, bool):
+                print(f"NOTE: Ruff - Invalid debug '{debug}', using default: False")
+                debug = False
+
+            # Validate isolated flag
+            isolated = config.get('isolated', False)
+            if not isinstance(isolated, bool):
+                print(f"NOTE: Ruff - Invalid isolated '{isolated}', using default: False")
+                isolated = False
+
             # Validate format: rule codes are strings
-            valid_ignore = self._filter_valid_codes(ignore)
-            valid_select = self._filter_valid_codes(select)
+            valid_ignore, invalid_ignore = self._filter_valid_codes(ignore)
+            valid_select, invalid_select = self._filter_valid_codes(select)
 
             # Warn about invalid codes
-            if invalid := [c for c in ignore if c not in valid_ignore]:
-                print(f"NOTE: Ruff - Invalid ignore codes: {invalid}")
+            if invalid_ignore:
+                print(f"NOTE: Ruff - Invalid ignore codes: {invalid_ignore}")
 
-            if invalid := [c for c in select if c not in valid_select]:
-                print(f"NOTE: Ruff - Invalid select codes: {invalid}")
+            if invalid_select:
+                print(f"NOTE: Ruff - Invalid select codes: {invalid_select}")
 
-            # Log loaded codes
+            # Log loaded codes (debug flag applies from this config on)
+            self.debug = debug
             if valid_ignore:
-                print(f"Ruff: Loaded ignore codes: {valid_ignore}")
+                self._log(f"Loaded ignore codes: {valid_ignore}")
             if valid_select:
-                print(f"Ruff: Loaded select codes: {valid_select}")
+                self._log(f"Loaded select codes: {valid_select}")
 
             return {
                 'ignore': valid_ignore,
                 'select': valid_select,
-                'timeout': timeout
+                'timeout': timeout,
+                'debug': debug,
+                'isolated': isolated
             }
 
         except json.JSONDecodeError as e:
@@ -215,6 +296,11 @@ class Ruff(Linter):
         Uses temporary file approach (@) instead of stdin to avoid
         Ruff's 'ignoring file in favor of stdin' warning.
         """
+        # Reuse command built for same executable and rules
+        key = (self.ruff_path, tuple(self.select_codes), tuple(self.ignore_codes), self.isolated)
+        if cmd := Ruff._cmd_cache.get(key):
+            return cmd
+
         cmd = [
             self.ruff_path,
             'check',
@@ -229,11 +315,21 @@ class Ruff(Linter):
         if self.ignore_codes:
             cmd.extend(['--ignore', ','.join(self.ignore_codes)])
 
+        # Skip pyproject.toml/ruff.toml discovery (plugin config only)
+        if self.isolated:
+            cmd.append('--isolated')
+
         # Use @ which CudaLint replaces with temp file path
         cmd.append('@')
 
-        print(f"Ruff: Command: {' '.join(cmd)}")
-        return tuple(cmd)
+        self._log(f"Command: {' '.join(cmd)}")
+        cmd = Ruff._cmd_cache[key] = tuple(cmd)
+        return cmd
+
+    def _log(self, message):
+        """Print diagnostic message (only with "debug": true in config)."""
+        if self.debug:
+            print(f"Ruff: {message}")
 
     def _log_status(self):
         """Print diagnostic information."""
@@ -247,7 +343,7 @@ class Ruff(Linter):
             status.append(f"{ignore_count} ignored rule{'s' if ignore_count != 1 else ''}")
 
         status_str = ', '.join(status) if status else "default rules"
-        print(f"Ruff: Active with {status_str}")
+        self._log(f"Active with {status_str}")
 
     def tmpfile(self, cmd, code, suffix=''):
         """Ensure .py extension for proper Ruff detection."""
@@ -264,10 +360,10 @@ class Ruff(Linter):
         """Override to capture and log Ruff summary lines."""
         output = super().run(cmd, code)
 
-        if output:
-            for line in output.splitlines():
-                if line.startswith('[*] '):
-                    print(f"Ruff: {line}")
+        # Scan in place (no list of all diagnostic lines)
+        if output and '[*] ' in output:
+            for match in self._SUMMARY_LINE_RE.finditer(output):
+                self._log(match.group())
 
         return output
 
@@ -276,6 +372,10 @@ class Ruff(Linter):
         if not self.ruff_path:
             return None
 
+        # Reuse cached version for same executable
+        if Ruff._version_cache and Ruff._version_cache[0] == self.ruff_path:
+            return Ruff._version_cache[1]
+
         try:
             import subprocess
             result = subprocess.run(
@@ -286,17 +386,373 @@ class Ruff(Linter):
             )
             if result.returncode == 0:
                 # Output format: "ruff 0.1.8"
-                return result.stdout.strip().split()[-1]
+                version = result.stdout.strip().split()[-1]
+                Ruff._version_cache = (self.ruff_path, version)
+                return version
         except Exception:
             pass
 
         return None
 
+    def format_code(self, code, filename):
+        """Format code via persistent Ruff server.
+
+        Returns formatted code, or None if the caller should fall back
+        to the one-shot `ruff format` CLI. Raises TimeoutError if the
+        server does not answer within timeout (no second wait on CLI).
+        """
+        if not self.ruff_path or not filename or Ruff._worker_failed_path == self.ruff_path:
+            return None
+
+        if self.isolated:
+            # Config files ignored (editorOnly): no lookup, workspace is
+            # just the directory of the first formatted file
+            root = os.path.dirname(os.path.abspath(filename))
+        else:
+            # Server workspace = project root, so it resolves the same
+            # config files as `ruff format --stdin-filename`
+            root = RuffServer.project_root(filename)
+            if not root:
+                return None
+
+        # One server for all projects (each root is a workspace folder)
+        worker = Ruff._worker
+        if (worker is None or worker.ruff_path != self.ruff_path
+                or worker.isolated != self.isolated or not worker.alive()):
+            if worker:
+                worker.close()
+            Ruff._worker = None
+            try:
+                worker = Ruff._worker = RuffServer(self.ruff_path, root, self.timeout, self.isolated)
+                self._log(f"Started server worker: {self.ruff_path} ({root})")
+            except TimeoutError:
+                # Slow start: retry next time, but don't wait again on CLI
+                raise
+            except Exception as e:
+                print(f"NOTE: Ruff server unavailable, using CLI: {e}")
+                Ruff._worker_failed_path = self.ruff_path
+                return None
+
+        try:
+            # Add new project root / reload its edited config files
+            if not self.isolated:
+                worker.sync_root(root)
+            return worker.format(code, filename, self.timeout)
+        except TimeoutError:
+            worker.close()
+            Ruff._worker = None
+            raise
+        except Exception as e:
+            print(f"NOTE: Ruff server failed, using CLI: {e}")
+            worker.close()
+            Ruff._worker = None
+            return None
+
+class RuffServer:
+    """Long-lived `ruff server` process spoken to over LSP (stdio).
+
+    Amortizes process spawn across Format commands. Project roots are
+    workspace folders of one server; their config files are watched by
+    mtime/size. Only requests whose result is unambiguous are served
+    here; anything else returns None so callers fall back to the CLI.
+    """
+
+    class ResponseError(Exception):
+        """LSP error response from server (process still usable)."""
+
+    # Line breaks recognized by LSP positions
+    _EOL_RE = re.compile(r'\r\n|\r|\n')
+
+    # Project config files, in Ruff's lookup priority
+    CONFIG_FILES = ('.ruff.toml', 'ruff.toml', 'pyproject.toml')
+
+    # LSP FileChangeType values
+    _FILE_CREATED, _FILE_CHANGED, _FILE_DELETED = 1, 2, 3
+
+    @staticmethod
+    def project_root(filename):
+        """Nearest ancestor dir with Ruff config (same lookup as CLI), or None."""
+        directory = os.path.dirname(os.path.abspath(filename))
+        while True:
+            if (os.path.isfile(os.path.join(directory, '.ruff.toml'))
+                    or os.path.isfile(os.path.join(directory, 'ruff.toml'))):
+                return directory
+
+            # pyproject.toml counts only with a [tool.ruff] section
+            pyproject = os.path.join(directory, 'pyproject.toml')
+            if os.path.isfile(pyproject):
+                try:
+                    with open(pyproject, 'r', encoding='utf-8', errors='replace') as f:
+                        if '[tool.ruff' in f.read():
+                            return directory
+                except OSError:
+                    pass
+
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return None
+            directory = parent
+
+    @staticmethod
+    def config_stamp(root):
+        """Map of config file name -> (mtime_ns, size) for files present in root."""
+        stamp = {}
+        for name in RuffServer.CONFIG_FILES:
+            try:
+                st = os.stat(os.path.join(root, name))
+                stamp[name] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                pass
+        return stamp
+
+    def __init__(self, ruff_path, root, timeout, isolated=False):
+        import subprocess
+        import threading
+        import queue
+        import pathlib
+
+        self.ruff_path = ruff_path
+        self.isolated = isolated
+        self._roots = {root: self.config_stamp(root)}
+        self._next_id = 0
+        self._inbox = queue.Queue()
+        self._outbox = queue.Queue()
+        self._proc = subprocess.Popen(
+            [ruff_path, 'server'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            # No console window for the whole session (GUI parent on Windows)
+            creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+        )
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+        try:
+            root_uri = pathlib.Path(root).as_uri()
+            params = {
+                'processId': os.getpid(),
+                'rootUri': root_uri,
+                'workspaceFolders': [{'uri': root_uri, 'name': os.path.basename(root) or root}],
+                'capabilities': {
+                    'general': {'positionEncodings': ['utf-32', 'utf-16']},
+                    # Pull diagnostics: server doesn't lint on every didOpen
+                    'textDocument': {'diagnostic': {'dynamicRegistration': False}},
+                    # Roots added later; config changes reported by sync_root()
+                    'workspace': {
+                        'workspaceFolders': True,
+                        'didChangeWatchedFiles': {'dynamicRegistration': False}
+                    }
+                }
+            }
+
+            # Server equivalent of --isolated: ignore project config files
+            if isolated:
+                params['initializationOptions'] = {'settings': {'configurationPreference': 'editorOnly'}}
+
+            result = self._request('initialize', params, timeout)
+            self._notify('initialized', {})
+        except Exception:
+            self.close()
+            raise
+
+        # Positions are code points (utf-32) or UTF-16 units (LSP default)
+        self.encoding = (result or {}).get('capabilities', {}).get('positionEncoding', 'utf-16')
+
+    def alive(self):
+        """Check whether server process is still running."""
+        return self._proc.poll() is None
+
+    def close(self):
+        """Stop server process (also unblocks a stuck writer thread)."""
+        self._outbox.put(None)
+        try:
+            self._proc.kill()
+            self._proc.wait(timeout=1)
+        except Exception:
+            pass
+
+    def sync_root(self, root):
+        """Add root as workspace folder, or report its changed config files."""
+        import pathlib
+
+        stamp = self.config_stamp(root)
+        old = self._roots.get(root)
+        if old == stamp:
+            return
+
+        self._roots[root] = stamp
+        root_uri = pathlib.Path(root).as_uri()
+
+        if old is None:
+            self._notify('workspace/didChangeWorkspaceFolders', {
+                'event': {'added': [{'uri': root_uri, 'name': os.path.basename(root) or root}], 'removed': []}
+            })
+            return
+
+        changes = []
+        for name in RuffServer.CONFIG_FILES:
+            if name in stamp and name not in old:
+                change = RuffServer._FILE_CREATED
+            elif name in old and name not in stamp:
+                change = RuffServer._FILE_DELETED
+            elif stamp.get(name) != old.get(name):
+                change = RuffServer._FILE_CHANGED
+            else:
+                continue
+            changes.append({'uri': pathlib.Path(root, name).as_uri(), 'type': change})
+
+        self._notify('workspace/didChangeWatchedFiles', {'changes': changes})
+
+    def format(self, code, filename, timeout):
+        """Return formatted code (unchanged if already formatted), or None if result is ambiguous."""
+        # UTF-16 positions match str indexes only for BMP-only text
+        if self.encoding != 'utf-32' and len(code.encode('utf-16-le')) != 2 * len(code):
+            return None
+
+        import pathlib
+        import time
+
+        # One time budget for all requests of this call
+        deadline = time.monotonic() + timeout
+
+        uri = pathlib.Path(os.path.abspath(filename)).as_uri()
+        self._notify('textDocument/didOpen', {
+            'textDocument': {'uri': uri, 'languageId': 'python', 'version': 1, 'text': code}
+        })
+
+        try:
+            edits = self._request('textDocument/formatting', {
+                'textDocument': {'uri': uri},
+                'options': {'tabSize': 4, 'insertSpaces': True}
+            }, max(deadline - time.monotonic(), 0))
+
+            if edits:
+                # Universal newlines, as CLI path (line-ending = "cr-lf")
+                formatted = self._apply_edits(code, edits)
+                return formatted.replace('\r\n', '\n').replace('\r', '\n')
+
+            # No edits: already formatted, syntax error or file excluded by
+            # project config (CLI formats those). Probe with trailing blank
+            # lines, which formatter always removes from a formattable file.
+            self._notify('textDocument/didChange', {
+                'textDocument': {'uri': uri, 'version': 2},
+                'contentChanges': [{'text': code + '\n\n'}]
+            })
+            probe = self._request('textDocument/formatting', {
+                'textDocument': {'uri': uri},
+                'options': {'tabSize': 4, 'insertSpaces': True}
+            }, max(deadline - time.monotonic(), 0))
+        except RuffServer.ResponseError:
+            return None
+        finally:
+            self._notify('textDocument/didClose', {'textDocument': {'uri': uri}})
+
+        # Probe formatted: file is already formatted; otherwise let CLI decide
+        return code if probe else None
+
+    def _apply_edits(self, text, edits):
+        """Apply LSP TextEdits to text (bottom to top)."""
+        starts = [0] + [m.end() for m in self._EOL_RE.finditer(text)]
+
+        def offset(pos):
+            if pos['line'] >= len(starts):
+                return len(text)
+            return min(starts[pos['line']] + pos['character'], len(text))
+
+        spans = sorted(
+            ((offset(e['range']['start']), offset(e['range']['end']), e['newText']) for e in edits),
+            reverse=True
+        )
+        for start, end, new_text in spans:
+            text = text[:start] + new_text + text[end:]
+
+        return text
+
+    def _send(self, message):
+        """Write one JSON-RPC message with Content-Length framing."""
+        import json
+
+        # Queued for writer thread: a server not reading stdin can't
+        # block the UI past the request deadline
+        body = json.dumps(message).encode('utf-8')
+        self._outbox.put(b'Content-Length: %d\r\n\r\n' % len(body) + body)
+
+    def _write_loop(self):
+        """Writer thread: send queued messages until None or broken pipe."""
+        stdin = self._proc.stdin
+        try:
+            while (data := self._outbox.get()) is not None:
+                stdin.write(data)
+                stdin.flush()
+        except Exception:
+            pass
+
+    def _notify(self, method, params):
+        """Send notification (no response expected)."""
+        self._send({'jsonrpc': '2.0', 'method': method, 'params': params})
+
+    def _request(self, method, params, timeout):
+        """Send request and wait for its response."""
+        import queue
+        import time
+
+        self._next_id += 1
+        request_id = self._next_id
+        self._send({'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params})
+
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                message = self._inbox.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                raise TimeoutError(f"no response to {method} (>{timeout}s)") from None
+
+            if message is None:
+                raise EOFError("server exited")
+
+            # Server-initiated request/notification: reply with null, skip
+            if 'method' in message:
+                if 'id' in message:
+                    self._send({'jsonrpc': '2.0', 'id': message['id'], 'result': None})
+                continue
+
+            if message.get('id') != request_id:
+                continue
+
+            if 'error' in message:
+                raise RuffServer.ResponseError(message['error'].get('message', 'unknown error'))
+
+            return message.get('result')
+
+    def _read_loop(self):
+        """Reader thread: queue incoming messages, None on EOF."""
+        import json
+
+        stdout = self._proc.stdout
+        try:
+            while True:
+                length = None
+                while line := stdout.readline():
+                    if not line.strip():
+                        break
+                    name, _, value = line.partition(b':')
+                    if name.strip().lower() == b'content-length':
+                        length = int(value)
+                if not line or length is None:
+                    break
+                self._inbox.put(json.loads(stdout.read(length)))
+        except Exception:
+            pass
+        self._inbox.put(None)
+
 class Command:
     """Menu commands for Ruff plugin."""
 
     DEFAULT_CONFIG = {
         "timeout": Ruff.DEFAULT_TIMEOUT,
+        "debug": False,
+        "isolated": False,
         "ignore": [
             "E501",   # line too long (handled by formatter)
             "W191",   # tab indentation
@@ -311,6 +767,31 @@ class Command:
         ]
     }
 
+    def __init__(self):
+        # Shared linter instance and (config, PATH) stamp it was built with
+        self._linter = None
+        self._linter_stamp = None
+
+        # Last clean fix result per file: filename -> (text hash, fix settings)
+        self._last_fixed_hash = {}
+
+    def _get_linter(self):
+        """Return shared Ruff instance, rebuilt when config file or PATH changes."""
+        path = os.path.join(app_path(APP_DIR_SETTINGS), Ruff.CONFIG_FILE)
+        try:
+            st = os.stat(path)
+            stamp = (st.st_mtime_ns, st.st_size, os.environ.get('PATH'))
+        except OSError:
+            stamp = (None, None, os.environ.get('PATH'))
+
+        # Rebuild if config/PATH changed or Ruff was not found last time
+        if self._linter is None or not self._linter.ruff_path or stamp != self._linter_stamp:
+            self._linter = Ruff(ed)
+            self._linter_stamp = stamp
+            self._last_fixed_hash.clear()
+
+        return self._linter
+
     def _get_undo_hotkey(self):
         """Get configured hotkey for Undo command."""
         try:
@@ -332,6 +813,8 @@ class Command:
         path = os.path.join(app_path(APP_DIR_SETTINGS), Ruff.CONFIG_FILE)
 
         if not os.path.isfile(path):
+            import json
+
             try:
                 os.makedirs(os.path.dirname(path), exist_ok=True)
                 with open(path, 'w', encoding='utf-8') as f:
@@ -347,20 +830,20 @@ class Command:
         else:
             msg_box(f"Failed to open config file:\n{path}", MB_OK | MB_ICONWARNING)
 
-    def _apply_changes_preserving_states(self, old_text, new_text):
+    def _apply_changes_preserving_states(self, linter, old_text, new_text):
         """Apply changes preserving line states using hybrid approach.
 
         Fast path (same line count): Native API - O(1) replace + O(n) comparison
         Slow path (lines added/removed): Myers diff - O(ND)
         """
-        old_lines = old_text.splitlines(keepends=False)
-        new_lines = new_text.splitlines(keepends=False)
-
-        # Fast path 1: No changes at all
+        # Fast path 1: No changes at all (checked before splitting)
         if old_text == new_text:
-            print("Ruff: Applying changes - No changes (skipped)")
+            linter._log("Applying changes - No changes (skipped)")
             return
 
+        old_lines = old_text.splitlines(keepends=False)
+        new_lines = new_text.splitlines(keepends=False)
+
         # Save caret position
         carets = ed.get_carets()
         if carets:
@@ -373,7 +856,7 @@ class Command:
             # Fast path 2: Same line count (95% of cases)
             # Use Native API for maximum speed
             if len(old_lines) == len(new_lines):
-                print(f"Ruff: Applying changes - Fast path ({len(old_lines)} lines)")
+                linter._log(f"Applying changes - Fast path ({len(old_lines)} lines)")
 
                 # Save current line states
                 old_states = ed.get_prop(PROP_LINE_STATES)
@@ -389,28 +872,48 @@ class Command:
                 )
 
                 # Restore states for unchanged lines
+                # (PROP_LINE_STATES is read-only: set line by line from precomputed vector)
                 if old_states and len(old_states) >= len(old_lines):
-                    unchanged_count = 0
-
-                    for i in range(len(new_lines)):
-                        if i < len(old_lines) and old_lines[i] == new_lines[i]:
-                            # Line unchanged, restore old state
-                            ed.set_prop(PROP_LINE_STATE, (i, old_states[i]))
-                            unchanged_count += 1
-                        else:
-                            # Line changed, mark as changed
-                            ed.set_prop(PROP_LINE_STATE, (i, LINESTATE_CHANGED))
+                    # Plain str compare: exits early on length mismatch; hashing
+                    # fresh splitlines() strings would scan every line anyway
+                    changed = LINESTATE_CHANGED
+                    new_states = [
+                        state if old == new else changed
+                        for old, new, state in zip(old_lines, new_lines, old_states)
+                    ]
+
+                    set_prop = ed.set_prop
+                    for i, state in enumerate(new_states):
+                        set_prop(PROP_LINE_STATE, (i, state))
 
                 return
 
             # Slow path: Line count changed (5% of cases)
-            # Use Myers diff algorithm for perfect accuracy
-            print(f"Ruff: Applying changes - Slow path (Myers diff: {len(old_lines)} -> {len(new_lines)} lines)")
+            old_count, new_count = len(old_lines), len(new_lines)
+            limit = min(old_count, new_count)
+
+            # Common prefix/suffix (typical --fix: lines added/removed in one block)
+            prefix = 0
+            while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+                prefix += 1
+
+            suffix = 0
+            while suffix < limit - prefix and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+                suffix += 1
+
+            if prefix + suffix == limit:
+                # Single block insert/delete: no diff needed
+                linter._log(f"Applying changes - Slow path (single block: {old_count} -> {new_count} lines)")
+                tag = 'insert' if old_count < new_count else 'delete'
+                opcodes = [(tag, prefix, old_count - suffix, prefix, new_count - suffix)]
+            else:
+                # Use Myers diff algorithm for perfect accuracy
+                linter._log(f"Applying changes - Slow path (Myers diff: {old_count} -> {new_count} lines)")
 
-            import difflib
+                import difflib
 
-            matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
-            opcodes = list(matcher.get_opcodes())
+                matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+                opcodes = list(matcher.get_opcodes())
 
             # Apply changes from TOP to BOTTOM with offset tracking
             offset = 0  # Track how much we've shifted
@@ -423,33 +926,20 @@ class Command:
                 adj_i1 = i1 + offset
                 adj_i2 = i2 + offset
 
-                if tag == 'replace':
-                    # Delete old lines
-                    for _ in range(i2 - i1):
-                        ed.delete(0, adj_i1, 0, adj_i1 + 1)
-
-                    # Insert new lines
-                    for idx in range(j1, j2):
-                        ed.insert(0, adj_i1, new_lines[idx] + '\n')
-                        adj_i1 += 1  # Move insertion point down
-
-                    # Update offset: removed (i2-i1) lines, added (j2-j1) lines
-                    offset += (j2 - j1) - (i2 - i1)
-
-                elif tag == 'delete':
-                    for _ in range(i2 - i1):
-                        ed.delete(0, adj_i1, 0, adj_i1 + 1)
-
-                    # Update offset
-                    offset -= (i2 - i1)
+                # One editor call per opcode (not per line)
+                if tag == 'delete':
+                    ed.delete(0, adj_i1, 0, adj_i2)
+                else:
+                    # Build new lines once per opcode
+                    payload = '\n'.join(new_lines[j1:j2]) + '\n'
 
-                elif tag == 'insert':
-                    for idx in range(j1, j2):
-                        ed.insert(0, adj_i1, new_lines[idx] + '\n')
-                        adj_i1 += 1
+                    if tag == 'replace':
+                        ed.replace(0, adj_i1, 0, adj_i2, payload)
+                    else:
+                        ed.insert(0, adj_i1, payload)
 
-                    # Update offset
-                    offset += (j2 - j1)
+                # Update offset: removed (i2-i1) lines, added (j2-j1) lines
+                offset += (j2 - j1) - (i2 - i1)
 
             # Ensure last line has newline (Myers may miss it)
             if new_text.endswith('\n'):
@@ -505,12 +995,23 @@ class Command:
         """Internal method to apply fixes. Run Ruff --fix on current buffer (non-destructive, supports undo)."""
         import subprocess
 
-        linter = Ruff(ed)
+        linter = self._get_linter()
         if not linter.ruff_path:
             msg_box("Ruff executable not found!", MB_OK | MB_ICONERROR)
             return
 
         code = ed.get_text_all()
+        filename = ed.get_filename()
+
+        # Skip Ruff if buffer is unchanged since last fix with same settings.
+        # Only with "isolated": true - otherwise pyproject.toml/ruff.toml
+        # may change without notice, so Ruff must run every time.
+        fix_key = None
+        if linter.isolated:
+            fix_key = (hash(code), unsafe, linter.ruff_path, tuple(linter.select_codes), tuple(linter.ignore_codes))
+        if fix_key and self._last_fixed_hash.get(filename) == fix_key:
+            msg_status("Ruff: No fixes needed (cached)")
+            return
 
         cmd = [linter.ruff_path, 'check', '--fix', '-']
 
@@ -521,33 +1022,45 @@ class Command:
             cmd.extend(['--select', ','.join(linter.select_codes)])
         if linter.ignore_codes:
             cmd.extend(['--ignore', ','.join(linter.ignore_codes)])
+        if linter.isolated:
+            cmd.append('--isolated')
 
-        cmd.extend(['--stdin-filename', ed.get_filename() or 'untitled.py'])
+        cmd.extend(['--stdin-filename', filename or 'untitled.py'])
 
         try:
+            # Raw UTF-8 bytes: compare output before decoding it
+            code_bytes = code.encode('utf-8')
             result = subprocess.run(
                 cmd,
-                input=code,
+                input=code_bytes,
                 capture_output=True,
-                text=True,
                 timeout=linter.timeout
             )
+            stderr = result.stderr.decode('utf-8', errors='replace')
 
-            if result.returncode == 0 or result.returncode == 1:
-                fixed_code = result.stdout
+            # Universal newlines (as text=True did): buffer text is LF-only,
+            # Ruff may emit CRLF with line-ending = "cr-lf"/"native"
+            stdout = result.stdout.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
 
+            if result.returncode == 0 or result.returncode == 1:
                 # Check for syntax errors in stderr (concise format)
-                if result.stderr and ("invalid-syntax" in result.stderr or "Failed to parse" in result.stderr):
+                if stderr and ("invalid-syntax" in stderr or "Failed to parse" in stderr):
                     msg_status("Ruff: File has syntax errors - cannot apply fixes")
-                elif fixed_code and fixed_code != code:
-                    self._apply_changes_preserving_states(code, fixed_code)
+                elif stdout and stdout != code_bytes:
+                    fixed_code = stdout.decode('utf-8')
+                    self._apply_changes_preserving_states(linter, code, fixed_code)
+                    # Fixed output is stable: next click on it is a no-op
+                    if fix_key:
+                        self._last_fixed_hash[filename] = (hash(fixed_code),) + fix_key[1:]
                     # Get undo hotkey
                     hotkey = self._get_undo_hotkey()
                     msg_status(f"Ruff: Applied fixes ({hotkey} to undo)")
                 else:
+                    if fix_key:
+                        self._last_fixed_hash[filename] = fix_key
                     msg_status("Ruff: No fixes needed")
             else:
-                msg_status(f"Ruff --fix error: {result.stderr or result.stdout}")
+                msg_status(f"Ruff --fix error: {stderr or stdout.decode('utf-8', errors='replace')}")
 
         except subprocess.TimeoutExpired:
             msg_box(f"Ruff --fix timed out (>{linter.timeout}s)", MB_OK | MB_ICONERROR)
@@ -558,32 +1071,56 @@ class Command:
         """Run Ruff format on current buffer (non-destructive, supports undo)."""
         import subprocess
 
-        linter = Ruff(ed)
+        linter = self._get_linter()
         if not linter.ruff_path:
             msg_box("Ruff executable not found!", MB_OK | MB_ICONERROR)
             return
 
         code = ed.get_text_all()
 
+        # Persistent server first (no process spawn per format)
+        try:
+            formatted_code = linter.format_code(code, ed.get_filename())
+        except TimeoutError:
+            msg_box(f"Ruff format timed out (>{linter.timeout}s)", MB_OK | MB_ICONERROR)
+            return
+
+        if formatted_code is not None:
+            if formatted_code != code:
+                self._apply_changes_preserving_states(linter, code, formatted_code)
+                hotkey = self._get_undo_hotkey()
+                msg_status(f"Ruff: Formatted ({hotkey} to undo)")
+            else:
+                msg_status("Ruff: Already formatted")
+            return
+
         cmd = [linter.ruff_path, 'format', '-']
 
+        if linter.isolated:
+            cmd.append('--isolated')
+
         cmd.extend(['--stdin-filename', ed.get_filename() or 'untitled.py'])
 
         try:
+            # Raw UTF-8 bytes: compare output before decoding it
+            code_bytes = code.encode('utf-8')
             result = subprocess.run(
                 cmd,
-                input=code,
+                input=code_bytes,
                 capture_output=True,
-                text=True,
                 timeout=linter.timeout
             )
+            stderr = result.stderr.decode('utf-8', errors='replace')
 
-            if result.returncode == 0:
-                formatted_code = result.stdout
+            # Universal newlines (as text=True did): buffer text is LF-only,
+            # Ruff may emit CRLF with line-ending = "cr-lf"/"native"
+            stdout = result.stdout.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
 
-                if formatted_code and formatted_code != code:
+            if result.returncode == 0:
+                if stdout and stdout != code_bytes:
+                    formatted_code = stdout.decode('utf-8')
                     # Apply changes preserving line states
-                    self._apply_changes_preserving_states(code, formatted_code)
+                    self._apply_changes_preserving_states(linter, code, formatted_code)
                     # Get undo hotkey
                     hotkey = self._get_undo_hotkey()
                     msg_status(f"Ruff: Formatted ({hotkey} to undo)")
@@ -591,10 +1128,10 @@ class Command:
                     msg_status("Ruff: Already formatted")
             else:
                 # Check for syntax errors
-                if result.stderr and ("invalid-syntax" in result.stderr or "Failed to parse" in result.stderr):
+                if stderr and ("invalid-syntax" in stderr or "Failed to parse" in stderr):
                     msg_status("Ruff: File has syntax errors - cannot format")
                 else:
-                    msg_status(f"Ruff format error: {result.stderr or result.stdout}")
+                    msg_status(f"Ruff format error: {stderr or stdout.decode('utf-8', errors='replace')}")
 
         except subprocess.TimeoutExpired:
             msg_box(f"Ruff format timed out (>{linter.timeout}s)", MB_OK | MB_ICONERROR)
@@ -603,7 +1140,7 @@ class Command:
 
     def help(self):
         """Display plugin help."""
-        linter = Ruff(ed)
+        linter = self._get_linter()
         version_info = ""
         if linter.ruff_path:
             version = linter._get_ruff_version()
@@ -624,12 +1161,15 @@ class Command:
             f"- timeout: Subprocess timeout in seconds (default: {Ruff.DEFAULT_TIMEOUT})\n"
             "- ignore: Rule codes to ignore\n"
             "- select: Rule codes to enable\n"
+            "- debug: Print diagnostic messages to console (default: false)\n"
+            "- isolated: Ignore project config files, use plugin config only (default: false)\n"
             "Supports // and # comments in JSON file\n\n"
             "PROJECT CONFIG (optional):\n"
             "Ruff automatically reads pyproject.toml or ruff.toml\n"
             "from your project directory\n"
             "Plugin select/ignore take precedence over project,\n"
-            "other settings (line-length, etc.) come from project\n\n"
+            "other settings (line-length, etc.) come from project\n"
+            "Set isolated: true to skip project config lookup\n\n"
             "COMMON RULE CATEGORIES:\n"
             "- E/W: pycodestyle (style errors/warnings)\n"
             "- F: Pyflakes (logic errors)\n"